@@ -0,0 +1,93 @@
+"""
+Бенчмарк времени старта бэкенда
+Измеряет время импорта main.py и время до готовности (lifespan startup)
+Запуск: python benchmark_startup.py [количество запусков]
+"""
+import os
+import statistics
+import subprocess
+import sys
+
+# Каталог backend: дочерние процессы импортируют main.py отсюда, откуда бы ни запускали скрипт
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Код, который выполняется в отдельном процессе, чтобы каждый замер был "холодным"
+MEASURE_SCRIPT = """
+import asyncio
+import time
+
+t0 = time.perf_counter()
+import main
+t1 = time.perf_counter()
+
+
+async def startup():
+    async with main.app.router.lifespan_context(main.app):
+        return time.perf_counter()
+
+t2 = asyncio.run(startup())
+print(f"RESULT {t1 - t0:.6f} {t2 - t1:.6f}")
+"""
+
+
+def run_child(args):
+    """Запускает python в каталоге backend и возвращает результат; при ошибке печатает stderr"""
+    result = subprocess.run(
+        [sys.executable, *args],
+        capture_output=True,
+        text=True,
+        cwd=BACKEND_DIR,
+    )
+    if result.returncode != 0:
+        print(result.stderr, file=sys.stderr)
+        raise RuntimeError(f"Дочерний процесс завершился с кодом {result.returncode}")
+    return result
+
+
+def run_once():
+    """Запускает один замер и возвращает (время импорта, время до готовности) в секундах"""
+    output = run_child(["-c", MEASURE_SCRIPT]).stdout
+    for line in output.splitlines():
+        if line.startswith("RESULT "):
+            import_time, ready_time = line.split()[1:]
+            return float(import_time), float(ready_time)
+    raise RuntimeError(f"Не удалось получить результат замера:\n{output}")
+
+
+def top_imports(limit=10):
+    """Возвращает самые медленные модули по данным python -X importtime"""
+    stderr = run_child(["-X", "importtime", "-c", "import main"]).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = [part.strip() for part in line[len("import time:"):].split("|")]
+        rows.append((int(cumulative), name))
+    return sorted(rows, reverse=True)[:limit]
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print(f"Бенчмарк старта ({runs} запусков)...")
+
+    import_times = []
+    ready_times = []
+    for _ in range(runs):
+        import_time, ready_time = run_once()
+        import_times.append(import_time)
+        ready_times.append(ready_time)
+
+    print("\n" + "=" * 70)
+    print(f"Импорт main.py:       медиана {statistics.median(import_times) * 1000:.1f} мс, "
+          f"макс {max(import_times) * 1000:.1f} мс")
+    print(f"Startup (lifespan):   медиана {statistics.median(ready_times) * 1000:.1f} мс, "
+          f"макс {max(ready_times) * 1000:.1f} мс")
+    print("=" * 70)
+
+    print("\nСамые медленные импорты (cumulative, мкс):")
+    for cumulative, name in top_imports():
+        print(f"  {cumulative:>10}  {name}")
+
+
+if __name__ == "__main__":
+    main()
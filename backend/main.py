@@ -1,43 +1,32 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException, Depends, Header
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel, EmailStr
 from typing import Optional, List
+import asyncio
 import json
 import os
+import signal
+import sys
+import time
 import base64
-from pywebpush import webpush, WebPushException
-import py_vapid
 from datetime import datetime, timedelta
-import supabase
 from dotenv import load_dotenv
-from cryptography.hazmat.primitives import serialization
-from jose import JWTError, jwt
 import bcrypt
 import secrets
 
-load_dotenv()
-
-app = FastAPI(title="PWA Push Notifications API")
+# supabase, py_vapid, pywebpush, jose и cryptography импортируются лениво
+# (в lifespan и в функциях), чтобы импорт модуля оставался быстрым
 
-# Настройка CORS
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # В продакшене укажите конкретные домены
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+load_dotenv()
 
 # Инициализация Supabase
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 
-if SUPABASE_URL and SUPABASE_KEY:
-    supabase_client = supabase.create_client(SUPABASE_URL, SUPABASE_KEY)
-else:
-    supabase_client = None
-    print("Предупреждение: Supabase не настроен. Используется локальное хранилище.")
+# Клиент создается при старте приложения (см. lifespan)
+supabase_client = None
 
 # VAPID ключи (должны быть в .env файле или переменных окружения Render)
 VAPID_PRIVATE_KEY = os.getenv("VAPID_PRIVATE_KEY")
@@ -49,8 +38,29 @@ SECRET_KEY = os.getenv("SECRET_KEY", secrets.token_urlsafe(32))  # Генери
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30 * 24 * 60  # 30 дней
 
+# Общий бюджет остановки в секундах, отсчитывается от сигнала SIGTERM/SIGINT.
+# В него входят и ожидание запросов uvicorn (--timeout-graceful-shutdown, должен быть
+# меньше), и ожидание рассылок в lifespan. Render убивает процесс через 30 сек.
+SHUTDOWN_DEADLINE = float(os.getenv("SHUTDOWN_DEADLINE", "25"))
+
+# Сколько секунд из бюджета оставляем на удаление недействительных подписок
+SHUTDOWN_FLUSH_RESERVE = 3.0
+
+# Максимум устройств (подписок) на пользователя, лишние вытесняются по last_active_at
+MAX_DEVICES_PER_USER = int(os.getenv("MAX_DEVICES_PER_USER", "10"))
+
 security = HTTPBearer()
 
+# Состояние жизненного цикла: ready - прогрев завершен, draining - идет остановка,
+# shutdown_started_at - момент получения сигнала остановки (time.monotonic)
+app_state = {"ready": False, "draining": False, "shutdown_started_at": None}
+
+# Рассылки, которые выполняются прямо сейчас (дожидаемся их при остановке)
+inflight_deliveries = set()
+
+# Endpoint'ы, вернувшие 410 Gone, которые еще не удалены из хранилища
+pending_stale_endpoints = set()
+
 
 def normalize_vapid_private_key(key: str) -> str:
     """Нормализует VAPID приватный ключ из переменной окружения.
@@ -89,11 +99,21 @@ def normalize_vapid_private_key(key: str) -> str:
     return normalized
 
 
-# Конвертируем PEM ключ в base64url формат один раз при старте приложения
-# Это формат, который ожидает pywebpush
+# Ключи в формате, готовом к использованию, заполняются при старте приложения
+# VAPID_PRIVATE_KEY_BASE64URL - формат, который ожидает pywebpush
+# VAPID_PUBLIC_KEY_BASE64 - кэш ответа /api/vapid-public-key
 VAPID_PRIVATE_KEY_BASE64URL = None
-if VAPID_PRIVATE_KEY:
+VAPID_PUBLIC_KEY_BASE64 = None
+
+
+def load_vapid_private_key():
+    """Конвертирует PEM приватный ключ в base64url (формат, который ожидает pywebpush)"""
+    global VAPID_PRIVATE_KEY_BASE64URL
+    if not VAPID_PRIVATE_KEY:
+        return
     try:
+        from cryptography.hazmat.primitives import serialization
+
         normalized_key = normalize_vapid_private_key(VAPID_PRIVATE_KEY)
         # Загружаем приватный ключ из PEM строки
         private_key = serialization.load_pem_private_key(
@@ -115,24 +135,175 @@ if VAPID_PRIVATE_KEY:
         traceback.print_exc()
 
 
-# Если ключи заданы из .env, обрабатываем публичный ключ
-if VAPID_PUBLIC_KEY and isinstance(VAPID_PUBLIC_KEY, str) and not VAPID_PUBLIC_KEY.startswith("-----BEGIN"):
-    import base64
-    try:
-        # Добавляем padding если нужно
-        padding = '=' * (4 - len(VAPID_PUBLIC_KEY) % 4)
-        VAPID_PUBLIC_KEY_BYTES = base64.urlsafe_b64decode(VAPID_PUBLIC_KEY + padding)
-        VAPID_PUBLIC_KEY = VAPID_PUBLIC_KEY_BYTES
-    except:
-        # Если не получилось декодировать, пытаемся использовать py_vapid
+def public_key_from_private_pem() -> bytes:
+    """Вычисляет публичный ключ из PEM приватного ключа через py_vapid"""
+    import py_vapid
+
+    normalized_private_key = normalize_vapid_private_key(VAPID_PRIVATE_KEY)
+    vapid_key = py_vapid.Vapid01()
+    vapid_key.from_pem(normalized_private_key)
+    return vapid_key.public_key.public_key_bytes
+
+
+def load_vapid_public_key():
+    """Обрабатывает публичный ключ из .env и кэширует его base64url представление"""
+    global VAPID_PUBLIC_KEY, VAPID_PUBLIC_KEY_BASE64
+    # Если ключи заданы из .env, обрабатываем публичный ключ
+    if VAPID_PUBLIC_KEY and isinstance(VAPID_PUBLIC_KEY, str) and not VAPID_PUBLIC_KEY.startswith("-----BEGIN"):
+        try:
+            # Добавляем padding если нужно
+            padding = '=' * (4 - len(VAPID_PUBLIC_KEY) % 4)
+            VAPID_PUBLIC_KEY_BYTES = base64.urlsafe_b64decode(VAPID_PUBLIC_KEY + padding)
+            VAPID_PUBLIC_KEY = VAPID_PUBLIC_KEY_BYTES
+        except:
+            # Если не получилось декодировать, пытаемся использовать py_vapid
+            try:
+                if VAPID_PRIVATE_KEY and VAPID_PRIVATE_KEY.startswith("-----BEGIN"):
+                    VAPID_PUBLIC_KEY = public_key_from_private_pem()
+            except:
+                pass
+    VAPID_PUBLIC_KEY_BASE64 = encode_vapid_public_key()
+
+
+def encode_vapid_public_key() -> str:
+    """Конвертирует публичный ключ в base64 формат для фронтенда"""
+    if isinstance(VAPID_PUBLIC_KEY, bytes):
+        return base64.urlsafe_b64encode(VAPID_PUBLIC_KEY).decode('utf-8').rstrip('=')
+    elif isinstance(VAPID_PUBLIC_KEY, str):
+        # Если это уже base64 строка, используем как есть
+        if not VAPID_PUBLIC_KEY.startswith("-----BEGIN"):
+            return VAPID_PUBLIC_KEY
+        # Если это PEM, конвертируем через py_vapid
         try:
-            if VAPID_PRIVATE_KEY and VAPID_PRIVATE_KEY.startswith("-----BEGIN"):
-                normalized_private_key = normalize_vapid_private_key(VAPID_PRIVATE_KEY)
-                vapid_key = py_vapid.Vapid01()
-                vapid_key.from_pem(normalized_private_key)
-                VAPID_PUBLIC_KEY = vapid_key.public_key.public_key_bytes
+            public_key_bytes = public_key_from_private_pem()
+            return base64.urlsafe_b64encode(public_key_bytes).decode('utf-8').rstrip('=')
         except:
-            pass
+            return VAPID_PUBLIC_KEY
+    return str(VAPID_PUBLIC_KEY)
+
+
+def init_supabase():
+    """Создает клиент Supabase, если он настроен"""
+    global supabase_client
+    if SUPABASE_URL and SUPABASE_KEY:
+        import supabase
+        supabase_client = supabase.create_client(SUPABASE_URL, SUPABASE_KEY)
+    else:
+        supabase_client = None
+        print("Предупреждение: Supabase не настроен. Используется локальное хранилище.")
+
+
+def warm_up():
+    """Прогревает соединения и ленивые импорты до того, как приложение станет готовым"""
+    # Импортируем модули, которые понадобятся при первых запросах
+    import pywebpush  # noqa: F401
+    from jose import jwt  # noqa: F401
+
+    # Открываем соединение с Supabase, чтобы первый запрос не платил за TLS handshake
+    if supabase_client:
+        try:
+            supabase_client.table("users").select("id").limit(1).execute()
+        except Exception as e:
+            print(f"Предупреждение: не удалось прогреть соединение с Supabase: {e}")
+
+
+async def flush_stale_subscriptions():
+    """Удаляет из хранилища накопленные недействительные (410 Gone) подписки"""
+    global local_subscriptions
+    if not pending_stale_endpoints:
+        return
+    endpoints = list(pending_stale_endpoints)
+    pending_stale_endpoints.clear()
+    try:
+        if supabase_client:
+            # В поток уходит только сетевой запрос, локальное хранилище меняем в event loop
+            await asyncio.to_thread(
+                lambda: supabase_client.table("push_subscriptions").delete().in_("endpoint", endpoints).execute()
+            )
+        else:
+            local_subscriptions = [
+                s for s in local_subscriptions
+                if s["endpoint"] not in endpoints
+            ]
+    except Exception as e:
+        print(f"Ошибка при удалении недействительных подписок: {e}")
+        pending_stale_endpoints.update(endpoints)
+
+
+def begin_draining():
+    """Переводит приложение в режим остановки: readiness падает, новые рассылки отклоняются"""
+    app_state["ready"] = False
+    app_state["draining"] = True
+    if app_state["shutdown_started_at"] is None:
+        app_state["shutdown_started_at"] = time.monotonic()
+
+
+def install_shutdown_hook():
+    """Оборачивает обработчики сигналов uvicorn, чтобы режим остановки включался сразу по сигналу"""
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        previous = signal.getsignal(sig)
+
+        def handler(signum, frame, previous=previous):
+            begin_draining()
+            if callable(previous):
+                previous(signum, frame)
+            else:
+                # SIG_DFL/SIG_IGN: возвращаем прежнее поведение и повторяем сигнал
+                signal.signal(signum, previous)
+                signal.raise_signal(signum)
+
+        try:
+            signal.signal(sig, handler)
+        except ValueError:
+            # Сигналы можно перехватывать только из главного потока
+            return
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Старт: клиент Supabase, ключи, кэши и прогрев выполняются до readiness
+    await asyncio.to_thread(init_supabase)
+    load_vapid_private_key()
+    load_vapid_public_key()
+    await asyncio.to_thread(warm_up)
+    # uvicorn ставит свои обработчики сигналов до запуска lifespan, оборачиваем их
+    install_shutdown_hook()
+    app_state["ready"] = True
+    print("Приложение готово к работе")
+    sys.stdout.flush()
+
+    yield
+
+    # Остановка: дожидаемся начатых рассылок в пределах оставшегося бюджета
+    begin_draining()
+    elapsed = time.monotonic() - app_state["shutdown_started_at"]
+    drain_timeout = max(0.0, SHUTDOWN_DEADLINE - SHUTDOWN_FLUSH_RESERVE - elapsed)
+    if inflight_deliveries:
+        print(f"Ожидаем завершения {len(inflight_deliveries)} рассылок (до {drain_timeout:.1f} сек)")
+        if drain_timeout > 0:
+            _, pending = await asyncio.wait(set(inflight_deliveries), timeout=drain_timeout)
+        else:
+            pending = inflight_deliveries
+        if pending:
+            print(f"Предупреждение: {len(pending)} рассылок не успели завершиться")
+    try:
+        await asyncio.wait_for(flush_stale_subscriptions(), timeout=SHUTDOWN_FLUSH_RESERVE)
+    except asyncio.TimeoutError:
+        print("Предупреждение: не успели удалить недействительные подписки")
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+
+app = FastAPI(title="PWA Push Notifications API", lifespan=lifespan)
+
+# Настройка CORS
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],  # В продакшене укажите конкретные домены
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
 
 # Локальное хранилище подписок (если Supabase не используется)
 local_subscriptions = []
@@ -183,6 +354,8 @@ def get_password_hash(password: str) -> str:
 
 # Функции для работы с JWT токенами
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
+    from jose import jwt
+
     to_encode = data.copy()
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
@@ -194,6 +367,8 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
 
 
 def decode_access_token(token: str) -> Optional[dict]:
+    from jose import JWTError, jwt
+
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         return payload
@@ -228,6 +403,12 @@ class UserLogin(BaseModel):
 class PushSubscription(BaseModel):
     endpoint: str
     keys: dict
+    device_id: Optional[str] = None  # Идентификатор устройства, генерируется клиентом
+
+
+class DeviceTouch(BaseModel):
+    device_id: str
+    endpoint: Optional[str] = None  # Текущий endpoint устройства, если подписка есть
 
 
 class NotificationData(BaseModel):
@@ -246,6 +427,15 @@ async def root():
     return {"message": "PWA Push Notifications API", "status": "running"}
 
 
+@app.get("/api/health")
+async def health():
+    """Readiness probe: 200 после прогрева, 503 во время старта и остановки"""
+    if not app_state["ready"]:
+        status = "draining" if app_state["draining"] else "starting"
+        raise HTTPException(status_code=503, detail=status)
+    return {"status": "ready", "inflight_deliveries": len(inflight_deliveries)}
+
+
 @app.post("/api/register")
 async def register(user_data: UserRegister):
     """Регистрация нового пользователя"""
@@ -389,30 +579,43 @@ async def get_current_user_info(current_user: dict = Depends(get_current_user)):
 @app.get("/api/vapid-public-key")
 async def get_vapid_public_key():
     """Возвращает публичный VAPID ключ для подписки"""
-    # Конвертируем публичный ключ в base64 формат для фронтенда
-    import base64
-    if isinstance(VAPID_PUBLIC_KEY, bytes):
-        public_key_base64 = base64.urlsafe_b64encode(VAPID_PUBLIC_KEY).decode('utf-8').rstrip('=')
-    elif isinstance(VAPID_PUBLIC_KEY, str):
-        # Если это уже base64 строка, используем как есть
-        if not VAPID_PUBLIC_KEY.startswith("-----BEGIN"):
-            public_key_base64 = VAPID_PUBLIC_KEY
-        else:
-            # Если это PEM, конвертируем через py_vapid
-            try:
-                normalized_private_key = normalize_vapid_private_key(VAPID_PRIVATE_KEY)
-                vapid_key = py_vapid.Vapid01()
-                vapid_key.from_pem(normalized_private_key)
-                public_key_bytes = vapid_key.public_key.public_key_bytes
-                public_key_base64 = base64.urlsafe_b64encode(public_key_bytes).decode('utf-8').rstrip('=')
-            except:
-                public_key_base64 = VAPID_PUBLIC_KEY
-    else:
-        public_key_base64 = str(VAPID_PUBLIC_KEY)
-    
+    # Ключ вычисляется один раз при старте приложения
+    public_key_base64 = VAPID_PUBLIC_KEY_BASE64 or encode_vapid_public_key()
     return {"publicKey": public_key_base64}
 
 
+def enforce_device_cap(user_id: str) -> int:
+    """Оставляет пользователю не больше MAX_DEVICES_PER_USER подписок, удаляя давно неактивные.
+
+    Возвращает количество удаленных подписок.
+    """
+    global local_subscriptions
+    if MAX_DEVICES_PER_USER <= 0:
+        return 0
+    if supabase_client:
+        result = supabase_client.table("push_subscriptions").select("endpoint").eq(
+            "user_id", user_id
+        ).order("last_active_at", desc=True).execute()
+        evicted = [row["endpoint"] for row in result.data[MAX_DEVICES_PER_USER:]]
+        if evicted:
+            supabase_client.table("push_subscriptions").delete().in_("endpoint", evicted).execute()
+    else:
+        user_subs = sorted(
+            (sub for sub in local_subscriptions if str(sub.get("user_id")) == user_id),
+            key=lambda sub: sub.get("last_active_at") or "",
+            reverse=True
+        )
+        evicted = {sub["endpoint"] for sub in user_subs[MAX_DEVICES_PER_USER:]}
+        if evicted:
+            local_subscriptions = [
+                sub for sub in local_subscriptions
+                if sub["endpoint"] not in evicted
+            ]
+    if evicted:
+        print(f"Пользователь {user_id}: удалено {len(evicted)} неактивных устройств сверх лимита")
+    return len(evicted)
+
+
 @app.post("/api/subscribe")
 async def subscribe(subscription: PushSubscription, current_user: dict = Depends(get_current_user)):
     """Сохраняет подписку пользователя"""
@@ -426,16 +629,28 @@ async def subscribe(subscription: PushSubscription, current_user: dict = Depends
         if not subscription.keys or not subscription.keys.get("p256dh") or not subscription.keys.get("auth"):
             raise HTTPException(status_code=400, detail="Ключи подписки отсутствуют или неполные")
         
+        now = datetime.now().isoformat()
+        # device_id пишем только если клиент его прислал, чтобы не стереть уже привязанный
+        device_fields = {"device_id": subscription.device_id} if subscription.device_id else {}
+
         subscription_data = {
             "endpoint": subscription.endpoint,
             "keys": subscription.keys,
             "user_id": user_id,
-            "created_at": datetime.now().isoformat()
+            **device_fields,
+            "created_at": now,
+            "last_active_at": now
         }
 
         if supabase_client:
             # Сохраняем в Supabase
             try:
+                # Повторная подписка с того же устройства заменяет его старый endpoint
+                if subscription.device_id:
+                    supabase_client.table("push_subscriptions").delete().eq(
+                        "user_id", user_id
+                    ).eq("device_id", subscription.device_id).neq("endpoint", subscription.endpoint).execute()
+
                 # Проверяем, существует ли уже подписка с таким endpoint
                 existing = supabase_client.table("push_subscriptions").select("*").eq("endpoint", subscription.endpoint).execute()
                 
@@ -445,7 +660,9 @@ async def subscribe(subscription: PushSubscription, current_user: dict = Depends
                         "p256dh": subscription.keys.get("p256dh"),
                         "auth": subscription.keys.get("auth"),
                         "user_id": user_id,
-                        "created_at": datetime.now().isoformat()
+                        **device_fields,
+                        "created_at": now,
+                        "last_active_at": now
                     }).eq("endpoint", subscription.endpoint).execute()
                 else:
                     # Создаем новую подписку
@@ -454,8 +671,11 @@ async def subscribe(subscription: PushSubscription, current_user: dict = Depends
                         "p256dh": subscription.keys.get("p256dh"),
                         "auth": subscription.keys.get("auth"),
                         "user_id": user_id,
-                        "created_at": datetime.now().isoformat()
+                        **device_fields,
+                        "created_at": now,
+                        "last_active_at": now
                     }).execute()
+                enforce_device_cap(user_id)
                 return {"status": "success", "message": "Подписка сохранена"}
             except Exception as supabase_error:
                 import traceback
@@ -466,12 +686,23 @@ async def subscribe(subscription: PushSubscription, current_user: dict = Depends
         else:
             # Сохраняем локально (проверяем на дубликаты)
             global local_subscriptions
-            # Удаляем существующую подписку с таким же endpoint, если есть
+            # Сохраняем device_id, привязанный к этому endpoint ранее, если клиент его не прислал
+            if not subscription.device_id:
+                for sub in local_subscriptions:
+                    if sub["endpoint"] == subscription.endpoint and sub.get("device_id"):
+                        subscription_data["device_id"] = sub["device_id"]
+            # Удаляем существующую подписку с таким же endpoint или с того же устройства, если есть
             local_subscriptions = [
                 sub for sub in local_subscriptions
                 if sub["endpoint"] != subscription.endpoint
+                and not (
+                    subscription.device_id
+                    and sub.get("device_id") == subscription.device_id
+                    and str(sub.get("user_id")) == user_id
+                )
             ]
             local_subscriptions.append(subscription_data)
+            enforce_device_cap(user_id)
             return {"status": "success", "message": "Подписка сохранена"}
     except HTTPException:
         raise
@@ -480,6 +711,42 @@ async def subscribe(subscription: PushSubscription, current_user: dict = Depends
         raise HTTPException(status_code=500, detail=f"Ошибка при сохранении подписки: {str(e)}")
 
 
+@app.post("/api/touch")
+async def touch_device(touch: DeviceTouch, current_user: dict = Depends(get_current_user)):
+    """Отмечает устройство активным (клиент вызывает при каждом открытии приложения)"""
+    global local_subscriptions
+    try:
+        user_id = current_user["user_id"]
+        now = datetime.now().isoformat()
+        if supabase_client:
+            result = supabase_client.table("push_subscriptions").update({
+                "last_active_at": now
+            }).eq("user_id", user_id).eq("device_id", touch.device_id).execute()
+            # Подписки, созданные до появления device_id, привязываем к устройству по endpoint
+            if not result.data and touch.endpoint:
+                result = supabase_client.table("push_subscriptions").update({
+                    "device_id": touch.device_id,
+                    "last_active_at": now
+                }).eq("user_id", user_id).eq("endpoint", touch.endpoint).execute()
+            touched = len(result.data)
+        else:
+            touched = 0
+            for sub in local_subscriptions:
+                if str(sub.get("user_id")) != user_id:
+                    continue
+                if sub.get("device_id") == touch.device_id or (
+                    touch.endpoint and sub["endpoint"] == touch.endpoint
+                ):
+                    sub["device_id"] = touch.device_id
+                    sub["last_active_at"] = now
+                    touched += 1
+        if touched:
+            enforce_device_cap(user_id)
+        return {"status": "success", "touched": touched}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.post("/api/unsubscribe")
 async def unsubscribe(subscription: PushSubscription, current_user: dict = Depends(get_current_user)):
     """Удаляет подписку пользователя"""
@@ -503,18 +770,91 @@ async def unsubscribe(subscription: PushSubscription, current_user: dict = Depen
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def send_push(sub: dict, notification_payload: dict):
+    """Отправляет одно push-уведомление (блокирующий вызов, выполняется в потоке)"""
+    from pywebpush import webpush
+
+    # Проверяем, что ключ загружен
+    if not VAPID_PRIVATE_KEY_BASE64URL:
+        raise ValueError("VAPID приватный ключ не загружен. Проверьте конфигурацию.")
+
+    # Используем готовый ключ в формате base64url (конвертирован при старте приложения)
+    webpush(
+        subscription_info={
+            "endpoint": sub["endpoint"],
+            "keys": sub["keys"]
+        },
+        data=json.dumps(notification_payload),
+        vapid_private_key=VAPID_PRIVATE_KEY_BASE64URL,
+        vapid_claims={
+            "sub": VAPID_EMAIL
+        }
+    )
+
+
+async def deliver_notification(subscriptions: list, notification_payload: dict):
+    """Отправляет уведомление на все подписки и возвращает (успешно, с ошибкой, ошибочные endpoint'ы)"""
+    from pywebpush import WebPushException
+
+    success_count = 0
+    failed_count = 0
+    failed_endpoints = []
+
+    for sub in subscriptions:
+        try:
+            print(f"Отправка уведомления на endpoint: {sub['endpoint']}")
+            print(f"Данные уведомления: {notification_payload}")
+            await asyncio.to_thread(send_push, sub, notification_payload)
+            print(f"Уведомление успешно отправлено на {sub['endpoint']}")
+            success_count += 1
+        except WebPushException as e:
+            print(f"Ошибка WebPushException при отправке на {sub['endpoint']}: {str(e)}")
+            if hasattr(e, 'response') and e.response:
+                print(f"Response status: {e.response.status_code}")
+                print(f"Response text: {e.response.text if hasattr(e.response, 'text') else 'N/A'}")
+            failed_count += 1
+            failed_endpoints.append(sub["endpoint"])
+            # Если подписка недействительна, помечаем её на удаление
+            if hasattr(e, 'response') and e.response and e.response.status_code == 410:  # Gone
+                pending_stale_endpoints.add(sub["endpoint"])
+        except Exception as e:
+            # Обработка других ошибок при отправке
+            import traceback
+            print(f"Ошибка при отправке уведомления на {sub['endpoint']}: {str(e)}")
+            print(f"Traceback: {traceback.format_exc()}")
+            failed_count += 1
+            failed_endpoints.append(sub["endpoint"])
+
+    # Удаляем недействительные подписки одним запросом
+    await flush_stale_subscriptions()
+
+    return success_count, failed_count, failed_endpoints
+
+
 @app.post("/api/send-notification")
 async def send_notification(notification: NotificationData, current_user: dict = Depends(get_current_user)):
     """Отправляет push-уведомление конкретному пользователю (на все его устройства)"""
     global local_subscriptions
     try:
+        # Во время остановки новые рассылки не начинаем
+        if app_state["draining"]:
+            raise HTTPException(status_code=503, detail="Сервер останавливается, повторите запрос позже")
+
         # Определяем, какому пользователю отправлять уведомление
         target_user_id = notification.user_id or current_user["user_id"]
         
-        # Получаем подписки для указанного пользователя
+        # Получаем подписки для указанного пользователя: только самые активные устройства
+        # в пределах лимита (удаление лишних выполняют subscribe и touch)
         subscriptions = []
+        total_count = 0
         if supabase_client:
-            result = supabase_client.table("push_subscriptions").select("*").eq("user_id", target_user_id).execute()
+            query = supabase_client.table("push_subscriptions").select("*", count="exact").eq(
+                "user_id", target_user_id
+            ).order("last_active_at", desc=True)
+            if MAX_DEVICES_PER_USER > 0:
+                query = query.limit(MAX_DEVICES_PER_USER)
+            result = query.execute()
+            total_count = result.count if result.count is not None else len(result.data)
             for row in result.data:
                 subscriptions.append({
                     "endpoint": row["endpoint"],
@@ -530,9 +870,17 @@ async def send_notification(notification: NotificationData, current_user: dict =
                     "endpoint": sub["endpoint"],
                     "keys": sub["keys"]
                 }
-                for sub in local_subscriptions
+                for sub in sorted(
+                    local_subscriptions,
+                    key=lambda sub: sub.get("last_active_at") or "",
+                    reverse=True
+                )
                 if str(sub.get("user_id")) == target_user_id
             ]
+            total_count = len(subscriptions)
+            if MAX_DEVICES_PER_USER > 0:
+                subscriptions = subscriptions[:MAX_DEVICES_PER_USER]
+        skipped_count = total_count - len(subscriptions)
 
         if not subscriptions:
             return {"status": "error", "message": f"У пользователя {target_user_id} нет активных подписок"}
@@ -554,66 +902,23 @@ async def send_notification(notification: NotificationData, current_user: dict =
         }
 
         # Отправляем уведомление всем подписчикам
-        success_count = 0
-        failed_count = 0
-        failed_endpoints = []
-
-        for sub in subscriptions:
-            try:
-                print(f"Отправка уведомления на endpoint: {sub['endpoint']}")
-                print(f"Данные уведомления: {notification_payload}")
-                
-                # Проверяем, что ключ загружен
-                if not VAPID_PRIVATE_KEY_BASE64URL:
-                    raise ValueError("VAPID приватный ключ не загружен. Проверьте конфигурацию.")
-                
-                # Используем готовый ключ в формате base64url (конвертирован при старте приложения)
-                webpush(
-                    subscription_info={
-                        "endpoint": sub["endpoint"],
-                        "keys": sub["keys"]
-                    },
-                    data=json.dumps(notification_payload),
-                    vapid_private_key=VAPID_PRIVATE_KEY_BASE64URL,
-                    vapid_claims={
-                        "sub": VAPID_EMAIL
-                    }
-                )
-                print(f"Уведомление успешно отправлено на {sub['endpoint']}")
-                success_count += 1
-            except WebPushException as e:
-                print(f"Ошибка WebPushException при отправке на {sub['endpoint']}: {str(e)}")
-                if hasattr(e, 'response') and e.response:
-                    print(f"Response status: {e.response.status_code}")
-                    print(f"Response text: {e.response.text if hasattr(e.response, 'text') else 'N/A'}")
-                failed_count += 1
-                failed_endpoints.append(sub["endpoint"])
-                # Если подписка недействительна, удаляем её
-                if hasattr(e, 'response') and e.response and e.response.status_code == 410:  # Gone
-                    if supabase_client:
-                        supabase_client.table("push_subscriptions").delete().eq(
-                            "endpoint", sub["endpoint"]
-                        ).execute()
-                    else:
-                        local_subscriptions = [
-                            s for s in local_subscriptions
-                            if s["endpoint"] != sub["endpoint"]
-                        ]
-            except Exception as e:
-                # Обработка других ошибок при отправке
-                import traceback
-                print(f"Ошибка при отправке уведомления на {sub['endpoint']}: {str(e)}")
-                print(f"Traceback: {traceback.format_exc()}")
-                failed_count += 1
-                failed_endpoints.append(sub["endpoint"])
+        # Рассылка выполняется отдельной задачей: если запрос оборвется при остановке,
+        # lifespan дождется ее завершения
+        delivery = asyncio.create_task(deliver_notification(subscriptions, notification_payload))
+        inflight_deliveries.add(delivery)
+        delivery.add_done_callback(inflight_deliveries.discard)
+        success_count, failed_count, failed_endpoints = await asyncio.shield(delivery)
 
         return {
             "status": "success",
             "message": f"Уведомления отправлены",
             "success_count": success_count,
             "failed_count": failed_count,
-            "failed_endpoints": failed_endpoints
+            "failed_endpoints": failed_endpoints,
+            "skipped_count": skipped_count
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
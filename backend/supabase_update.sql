@@ -43,6 +43,18 @@ CREATE INDEX IF NOT EXISTS idx_push_subscriptions_user_id ON push_subscriptions(
 -- Индекс для endpoint уже существует, но проверим
 CREATE INDEX IF NOT EXISTS idx_endpoint ON push_subscriptions(endpoint);
 
+-- 3.1. Идентификатор устройства и время последней активности подписки
+-- device_id присылает клиент: повторная подписка с того же устройства заменяет старый endpoint
+-- last_active_at используется для вытеснения давно неактивных устройств сверх лимита
+ALTER TABLE push_subscriptions ADD COLUMN IF NOT EXISTS device_id TEXT;
+-- Колонка добавляется без DEFAULT: иначе все существующие строки получили бы одно и то же
+-- время миграции, и старые endpoint'ы стали бы неотличимы от живых
+ALTER TABLE push_subscriptions ADD COLUMN IF NOT EXISTS last_active_at TIMESTAMP WITH TIME ZONE;
+UPDATE push_subscriptions SET last_active_at = COALESCE(created_at, NOW()) WHERE last_active_at IS NULL;
+ALTER TABLE push_subscriptions ALTER COLUMN last_active_at SET DEFAULT NOW();
+CREATE INDEX IF NOT EXISTS idx_push_subscriptions_user_device ON push_subscriptions(user_id, device_id);
+CREATE INDEX IF NOT EXISTS idx_push_subscriptions_user_last_active ON push_subscriptions(user_id, last_active_at DESC);
+
 -- 4. Включение Row Level Security (RLS) для безопасности
 ALTER TABLE users ENABLE ROW LEVEL SECURITY;
 ALTER TABLE push_subscriptions ENABLE ROW LEVEL SECURITY;
@@ -39,6 +39,33 @@ const setToken = (token) => {
   }
 };
 
+// Идентификатор устройства: сохраняется между подписками, чтобы сервер
+// заменял старый endpoint этого устройства, а не копил историю
+const getDeviceId = () => {
+  let deviceId = localStorage.getItem("device_id");
+  if (!deviceId) {
+    deviceId =
+      window.crypto?.randomUUID?.() ||
+      Date.now().toString(36) + Math.random().toString(36).slice(2);
+    localStorage.setItem("device_id", deviceId);
+  }
+  return deviceId;
+};
+
+// Тело запроса /api/subscribe для подписки этого браузера
+const subscriptionPayload = (subscription) => ({
+  endpoint: subscription.endpoint,
+  device_id: getDeviceId(),
+  keys: {
+    p256dh: btoa(
+      String.fromCharCode(...new Uint8Array(subscription.getKey("p256dh")))
+    ),
+    auth: btoa(
+      String.fromCharCode(...new Uint8Array(subscription.getKey("auth")))
+    ),
+  },
+});
+
 function App() {
   const [deferredPrompt, setDeferredPrompt] = useState(null);
   const [showInstallButton, setShowInstallButton] = useState(false);
@@ -202,6 +229,27 @@ function App() {
       const subscription = await registration.pushManager.getSubscription();
       setIsSubscribed(!!subscription);
       setSubscriptionStatus(subscription ? "subscribed" : "not-subscribed");
+
+      // Отмечаем устройство активным, чтобы сервер не вытеснил его по лимиту.
+      // Если сервер уже удалил подписку этого устройства, регистрируем её заново
+      if (subscription) {
+        api
+          .post("/api/touch", {
+            device_id: getDeviceId(),
+            endpoint: subscription.endpoint,
+          })
+          .then((response) => {
+            if (response.data.touched === 0) {
+              return api.post(
+                "/api/subscribe",
+                subscriptionPayload(subscription)
+              );
+            }
+          })
+          .catch((error) =>
+            console.error("Ошибка при обновлении активности устройства:", error)
+          );
+      }
     } catch (error) {
       console.error("Ошибка при проверке подписки:", error);
       setSubscriptionStatus("not-subscribed");
@@ -242,19 +290,10 @@ function App() {
       });
 
       // Отправляем подписку на сервер с токеном авторизации
-      const subscribeResponse = await api.post("/api/subscribe", {
-        endpoint: subscription.endpoint,
-        keys: {
-          p256dh: btoa(
-            String.fromCharCode(
-              ...new Uint8Array(subscription.getKey("p256dh"))
-            )
-          ),
-          auth: btoa(
-            String.fromCharCode(...new Uint8Array(subscription.getKey("auth")))
-          ),
-        },
-      });
+      const subscribeResponse = await api.post(
+        "/api/subscribe",
+        subscriptionPayload(subscription)
+      );
 
       setIsSubscribed(true);
       setSubscriptionStatus("subscribed");